@@ -14,19 +14,25 @@
 
 import argparse
 import collections
+import contextlib
 import functools
+import io
 import logging
 import os
+import queue
 import sys
+import threading
 import urllib
 import urllib.parse
 
-from copy import deepcopy
-from itertools import combinations
-from xml.etree import ElementTree as etree
+from lxml import etree
 
 import slob
 
+log = logging.getLogger(__name__)
+
+PARSE_TAGS = ('description', 'full_name', 'xdxf', 'abbreviations', 'ar')
+
 ARTICLE_CONTENT_TYPE = 'text/html;charset=utf-8'
 
 ARTICLE_TEMPLATE = (
@@ -36,27 +42,65 @@ ARTICLE_TEMPLATE = (
     '%s'
 )
 
+ARTICLE_TEMPLATE_BYTES = ARTICLE_TEMPLATE.encode('utf-8')
+
+INPUT_BUFFER_SIZE = 1 << 20
+
 
 Tag = collections.namedtuple('Tag', 'name value')
 Content = collections.namedtuple('Content', 'text keys type')
 
+class TarMemberReader(io.BufferedReader):
+    #keeps tar archive open while its member is read,
+    #closing the member closes the archive
+
+    def __init__(self, tf, member, buffer_size=INPUT_BUFFER_SIZE):
+        super().__init__(tf.extractfile(member), buffer_size=buffer_size)
+        self.tarfile = tf
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.tarfile.close()
+
+
 def make_input(input_file_name):
     if input_file_name == '-':
-        return sys.stdin
+        return sys.stdin.buffer
     input_file_name = os.path.expanduser(input_file_name)
+    with open(input_file_name, 'rb') as f:
+        head = f.read(512)
+    if head.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<'):
+        #plain XML, no need to probe for tar archive
+        return open(input_file_name, 'rb', buffering=INPUT_BUFFER_SIZE)
     import tarfile
     try:
         tf = tarfile.open(input_file_name)
-    except:
-        #probably this is not tar archive, open regular file
-        return open(input_file_name)
+    except tarfile.TarError:
+        #not a tar archive, may be gzipped dict.xdxf
+        if head.startswith(b'\x1f\x8b'):
+            import gzip
+            return gzip.open(input_file_name)
+        return open(input_file_name, 'rb', buffering=INPUT_BUFFER_SIZE)
     else:
         for tar in tf:
             if os.path.basename(tar.name) == 'dict.xdxf':
-                return tf.extractfile(tar)
+                return TarMemberReader(tf, tar)
+        tf.close()
     raise IOError("%s doesn't look like a XDXF dictionary" % input_file_name)
 
 
+def fast_iter(context):
+    #free each element, and the siblings before it, once the consumer
+    #is done with it so that memory use doesn't grow with input size
+    for _, element in context:
+        yield element
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
 VISUAL_TAGS = frozenset(('ar',
                          'k',
                          'opt',
@@ -84,144 +128,198 @@ class XDXF():
         self.skip_article_title = skip_article_title
         self.remove_newline = remove_newline
 
-    def _tag_handler_ar(self, e, **_):
+    def _tag_handler_ar(self, e, _abbreviations):
         e.set('class', e.tag)
         e.tag = 'div'
 
-    def _tag_handler_c(self, child, **_):
+    def _tag_handler_c(self, child, _abbreviations):
         child.tag = 'span'
-        color = child.get('c', '')
-        child.attrib.clear()
+        attrib = child.attrib
+        color = attrib.pop('c', '')
+        if attrib:
+            attrib.clear()
         if color:
-            child.set('style', 'color: %s;' % color)
+            attrib['style'] = 'color: %s;' % color
 
-    def _tag_handler_iref(self, child, **_):
+    def _tag_handler_iref(self, child, _abbreviations):
         child.tag = 'a'
 
-    def _tag_handler_kref(self, child, **_):
+    def _tag_handler_kref(self, child, _abbreviations):
         child.tag = 'a'
         child.set('href', child.text)
 
-    def _tag_handler_su(self, child, **_):
+    def _tag_handler_su(self, child, _abbreviations):
         child.tag = 'div'
         child.set('class', 'su')
 
-    def _tag_handler_def(self, child, **_):
+    def _tag_handler_def(self, child, _abbreviations):
         child.tag = 'blockquote'
 
-    def _tag_handler_abr(self, child, **kw):
-        abbreviations = kw['abbreviations']
+    def _tag_handler_abr(self, child, abbreviations):
         child.tag = 'abbr'
-        abr = child.text
-        if abr in abbreviations:
-            child.set('title', abbreviations[abr])
-
-    def default_tag_handler(self, child, **_):
-        if child.tag in VISUAL_TAGS:
-            child.set('class', child.tag)
-            child.tag = 'div' if child.tag in BLOCK_TAGS else 'span'
+        title = abbreviations.get(child.text)
+        if title is not None:
+            child.set('title', title)
 
     def _mkabbrs(self, element):
         abbrs = {}
-        for abrdef in element:
-            if abrdef.tag.lower() == 'abr_def':
-                value = abrdef.find('v')
-                if value:
-                    value_txt = value.text
-                    for key in abrdef.findall('k'):
-                        abbrs[key.text] = value_txt
+        for abrdef in element.iterfind('abr_def'):
+            value = None
+            keys = []
+            for child in abrdef:
+                if child.tag == 'v':
+                    if value is None:
+                        value = child.text
+                elif child.tag == 'k':
+                    keys.append(child.text)
+            if value is not None:
+                for key in keys:
+                    abbrs[key] = value
         return abbrs
 
     def _transform_element(self, element, abbreviations):
-        handler = getattr(self, '_tag_handler_'+element.tag.lower(),
-                          self.default_tag_handler)
-        handler(element, abbreviations=abbreviations)
+        tag = element.tag
+        handler = self._HANDLERS.get(tag)
+        #visual tags match exactly, _tag_handler_* also in any case
+        if handler is None and not tag.islower():
+            handler = self._TAG_HANDLERS.get(tag.lower())
+        if handler:
+            handler(self, element, abbreviations)
 
 
-    def _text(self, xdxf_element, abbreviations):
-        element = deepcopy(xdxf_element)
+    def _text(self, element, abbreviations):
+        # transforms element in place, callers must not use it afterwards
         if self.skip_article_title:
-            tail = ''
-            for k in list(element.findall('k')):
-                if k.tail:
-                    tail += k.tail
-                element.remove(k)
+            tail = ''.join(k.tail for k in element.iterfind('k') if k.tail)
+            element[:] = [c for c in element if c.tag != 'k']
             tail = tail.lstrip()
             element.text = tail + element.text if element.text else tail
-        self._transform_element(element, abbreviations)
+        transform = self._transform_element
         for child in element.iter():
-            self._transform_element(child, abbreviations)
+            transform(child, abbreviations)
 
-        txt = etree.tostring(element, encoding='unicode')
+        txt = etree.tostring(element, encoding='utf-8')
         if self.remove_newline:
-            txt = txt.replace('\n', ' ')
-        return (ARTICLE_TEMPLATE % txt).encode('utf8')
-
-    def _mktitle(self, title_element, include_opts=()):
-        title = title_element.text
-        opt_i = -1
+            txt = txt.replace(b'\n', b' ')
+        return ARTICLE_TEMPLATE_BYTES % txt
+
+    def _mktitles(self, title_element):
+        #title fragments with the mask bit of the <opt> they belong to,
+        #0 for fragments present in every title
+        fragments = [(0, title_element.text)]
+        opt_bit = 1
         for c in title_element:
-            if c.tag == 'nu' and c.tail:
-                if title:
-                    title += c.tail
-                else:
-                    title = c.tail
-            if c.tag == 'opt':
-                opt_i += 1
-                if opt_i in include_opts:
-                    if title:
-                        title += c.text
-                    else:
-                        title = c.text
-                if c.tail:
-                    if title:
-                        title += c.tail
-                    else:
-                        title = c.tail
-        return title
+            if c.tag == 'nu':
+                fragments.append((0, c.tail))
+            elif c.tag == 'opt':
+                fragments.append((opt_bit, c.text))
+                fragments.append((0, c.tail))
+                opt_bit <<= 1
+        fragments = [(bit, text) for bit, text in fragments if text]
+        #each bit of the mask includes or omits one <opt>
+        for opts_mask in range(opt_bit):
+            yield ''.join(text for bit, text in fragments
+                          if opts_mask & bit == bit) or None
 
     def __iter__(self):
         yield from self.parse(self.input_file)
 
     def parse(self, f):
         abbreviations = {}
-        for _, element in etree.iterparse(f):
+        context = etree.iterparse(f, events=('end',),
+                                  tag=PARSE_TAGS,
+                                  huge_tree=True,
+                                  collect_ids=False,
+                                  remove_comments=True,
+                                  remove_pis=True)
+        for element in fast_iter(context):
             if element.tag == 'description':
                 yield Tag('copyright', element.text or '')
-                element.clear()
 
             if element.tag == 'full_name':
                 label = element.text or ''
                 yield Tag('label', label)
                 yield Tag('uri', urllib.parse.quote(label.encode('utf-8'), safe=''))
-                element.clear()
 
             if element.tag == 'xdxf':
                 yield Tag('lang_to', element.get('lang_to', ''))
                 yield Tag('lang_from', element.get('lang_from', ''))
-                element.clear()
 
             if element.tag == 'abbreviations':
                 abbreviations = self._mkabbrs(element)
 
             if element.tag == 'ar':
-                txt = self._text(element, abbreviations)
                 titles = []
-                for title_element in element.findall('k'):
-                    n_opts = len([c for c in title_element if c.tag == 'opt'])
-                    if n_opts:
-                        for j in range(n_opts+1):
-                            for comb in combinations(range(n_opts), j):
-                                titles.append(self._mktitle(title_element, comb))
-                    else:
-                        titles.append(self._mktitle(title_element))
+                for title_element in element.iterfind('k'):
+                    titles.extend(self._mktitles(title_element))
 
                 if titles:
+                    txt = self._text(element, abbreviations)
                     yield Content(txt, titles, ARTICLE_CONTENT_TYPE)
-                else:
-                    logging.warn('No title found in article:\n%s',
-                                 etree.tostring(element, encoding='utf8'))
-                element.clear()
+                elif log.isEnabledFor(logging.WARNING):
+                    log.warning('No title found in article:\n%s',
+                                etree.tostring(element, encoding='unicode'))
+
+
+def _visual_tag_handler(css_class, html_tag):
+    def handler(self, child, _abbreviations):
+        child.set('class', css_class)
+        child.tag = html_tag
+    return handler
+
+
+XDXF._TAG_HANDLERS = {name[len('_tag_handler_'):]: handler
+                      for name, handler in vars(XDXF).items()
+                      if name.startswith('_tag_handler_')}
+
+XDXF._HANDLERS = {
+    tag: _visual_tag_handler(tag, 'div' if tag in BLOCK_TAGS else 'span')
+    for tag in VISUAL_TAGS}
+
+XDXF._HANDLERS.update(XDXF._TAG_HANDLERS)
+
+
+def read_ahead(items, maxsize=64):
+    #iterate items in a background thread so that parsing overlaps
+    #with compression, which releases the GIL
+    q = queue.Queue(maxsize=maxsize)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        #give up once consumer is gone instead of blocking forever
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except BaseException as ex:
+            put(ex)
+        finally:
+            put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = q.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        #make sure producer no longer reads input when this returns
+        stop.set()
+        producer.join()
 
 
 def parse_args():
@@ -283,20 +381,19 @@ def main():
 
     basename = os.path.basename(args.input_file)
 
-    noext = basename
-
     if outname is None:
-        while True:
-            noext, _ext = os.path.splitext(noext)
-            if not _ext:
-                break
+        #like splitext, leading dots are part of the name
+        stem = basename.lstrip(os.path.extsep)
+        noext = (basename[:len(basename) - len(stem)] +
+                 stem.split(os.path.extsep, 1)[0])
         outname = os.path.extsep.join((noext, 'slob'))
 
     def p(s):
         sys.stdout.write(s)
         sys.stdout.flush()
 
-    with slob.create(outname,
+    with make_input(args.input_file) as input_file, \
+         slob.create(outname,
                      compression=args.compression,
                      workdir=args.work_dir,
                      min_bin_size=args.bin_size*1024,
@@ -311,7 +408,7 @@ def main():
         slb.tag('uri', '')
         slb.tag('copyright', '')
         slb.tag('created.by', args.created_by)
-        xdxf = XDXF(make_input(args.input_file),
+        xdxf = XDXF(input_file,
                     skip_article_title=args.skip_article_title,
                     remove_newline=args.remove_newline)
         content_dir = os.path.dirname(__file__)
@@ -319,12 +416,13 @@ def main():
                      include_only={'js', 'css'},
                      prefix='~/')
         print('Adding content...')
-        for i, item in enumerate(xdxf):
-            if i % 100 == 0 and i: p('.')
-            if i % 5000 == 0 and i: p(' {}\n'.format(i))
-            if isinstance(item, Tag):
-                slb.tag(item.name, item.value)
-            else:
-                slb.add(item.text, *item.keys, content_type=item.type)
+        with contextlib.closing(read_ahead(xdxf)) as items:
+            for i, item in enumerate(items):
+                if i % 100 == 0 and i: p('.')
+                if i % 5000 == 0 and i: p(' {}\n'.format(i))
+                if isinstance(item, Tag):
+                    slb.tag(item.name, item.value)
+                else:
+                    slb.add(item.text, *item.keys, content_type=item.type)
 
     print('\nAll done in %s\n' % observer.end('all'))